@@ -4,17 +4,17 @@ Download the NASA Exoplanet Archive pscomppars table (composite parameters,
 one row per confirmed exoplanet) and save as Parquet for Viewpoints.
 
 Install dependencies:
-    pip install requests pandas pyarrow
+    pip install requests pandas pyarrow numexpr
 
 Run:
     python data/exoplanets/download_exoplanets.py
 """
 
 import os
-import io
 import requests
 import pandas as pd
 import numpy as np
+import numexpr as ne
 
 OUTPUT_FILE = "data/exoplanets/exoplanets.parquet"
 
@@ -98,72 +98,97 @@ KEEP_COLUMNS = [
 
 # ── Derived columns ───────────────────────────────────────────────────────
 
+# Archive columns read by add_derived_columns
+DERIVED_INPUTS = [
+    "pl_orbper", "pl_orbsmax", "pl_bmasse", "pl_insol", "pl_rade",
+    "pl_eqt", "st_rad", "st_lum", "sy_dist",
+    "sy_bmag", "sy_vmag", "sy_jmag", "sy_hmag", "sy_kmag",
+]
+
+
+def safe_log10(values):
+    """float32 log10 of a column, NaN where the input is not positive."""
+    a = np.asarray(values, dtype=np.float32)
+    out = np.full_like(a, np.nan)
+    np.log10(a, where=a > 0, out=out)
+    return out
+
+
 def add_derived_columns(df):
     """Add computed columns useful for visualization."""
-    # Log-scale versions of spanning-many-orders quantities
-    for col, log_col in [
-        ("pl_orbper",  "log_period_days"),
-        ("pl_orbsmax", "log_sma_au"),
-        ("pl_bmasse",  "log_mass_earth"),
-        ("pl_insol",   "log_insolation"),
-        ("sy_dist",    "log_distance_pc"),
-    ]:
-        if col in df.columns:
-            df[log_col] = np.log10(df[col].astype(float).replace(0, np.nan))
-
-    # Planet radius in log scale
-    if "pl_rade" in df.columns:
-        df["log_radius_earth"] = np.log10(
-            df["pl_rade"].astype(float).replace(0, np.nan))
-
-    # Stellar luminosity from log to linear
-    if "st_lum" in df.columns:
-        df["st_lum_linear"] = 10.0 ** df["st_lum"].astype(float)
-
-    # Habitable zone estimate (simple sqrt(luminosity) scaling)
-    if "st_lum" in df.columns:
-        lum = 10.0 ** df["st_lum"].astype(float)
-        df["hz_inner_au"] = 0.75 * np.sqrt(lum)
-        df["hz_outer_au"] = 1.77 * np.sqrt(lum)
-        if "pl_orbsmax" in df.columns:
-            sma = df["pl_orbsmax"].astype(float)
-            df["in_hz"] = ((sma >= df["hz_inner_au"]) &
-                           (sma <= df["hz_outer_au"])).astype(np.int8)
-
-    # Surface gravity estimate: g ~ M/R^2 (in Earth units)
-    if "pl_bmasse" in df.columns and "pl_rade" in df.columns:
-        m = df["pl_bmasse"].astype(float)
-        r = df["pl_rade"].astype(float)
-        df["pl_surf_grav_earth"] = m / (r ** 2)
-        df["log_surf_grav"] = np.log10(
-            df["pl_surf_grav_earth"].replace(0, np.nan))
-
-    # Escape velocity estimate: v_esc ~ sqrt(M/R) (relative to Earth)
-    if "pl_bmasse" in df.columns and "pl_rade" in df.columns:
-        m = df["pl_bmasse"].astype(float)
-        r = df["pl_rade"].astype(float)
-        df["pl_vesc_earth"] = np.sqrt(m / r.replace(0, np.nan))
-
-    # TSM-like metric (Transmission Spectroscopy Metric, simplified)
-    # TSM ~ (Rp^3 * Teq) / (Mp * Rs^2 * 10^(mag/5))
-    if all(c in df.columns for c in
-           ["pl_rade", "pl_eqt", "pl_bmasse", "st_rad", "sy_jmag"]):
-        rp = df["pl_rade"].astype(float)
-        teq = df["pl_eqt"].astype(float)
-        mp = df["pl_bmasse"].astype(float)
-        rs = df["st_rad"].astype(float)
-        jmag = df["sy_jmag"].astype(float)
-        df["tsm_approx"] = (rp**3 * teq) / (mp * rs**2 * 10**(jmag / 5))
-
-    # Color indices
-    if "sy_bmag" in df.columns and "sy_vmag" in df.columns:
-        df["bv_color"] = df["sy_bmag"].astype(float) - df["sy_vmag"].astype(float)
-    if "sy_jmag" in df.columns and "sy_hmag" in df.columns:
-        df["jh_color"] = df["sy_jmag"].astype(float) - df["sy_hmag"].astype(float)
-    if "sy_hmag" in df.columns and "sy_kmag" in df.columns:
-        df["hk_color"] = df["sy_hmag"].astype(float) - df["sy_kmag"].astype(float)
-    if "sy_jmag" in df.columns and "sy_kmag" in df.columns:
-        df["jk_color"] = df["sy_jmag"].astype(float) - df["sy_kmag"].astype(float)
+    # Convert each input column to float32 once; every formula below is
+    # plain numpy math on these arrays
+    cols = {name: df[name].to_numpy(dtype=np.float32)
+            for name in DERIVED_INPUTS if name in df.columns}
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Log-scale versions of spanning-many-orders quantities
+        for col, log_col in [
+            ("pl_orbper",  "log_period_days"),
+            ("pl_orbsmax", "log_sma_au"),
+            ("pl_bmasse",  "log_mass_earth"),
+            ("pl_insol",   "log_insolation"),
+            ("sy_dist",    "log_distance_pc"),
+        ]:
+            if col in cols:
+                df[log_col] = safe_log10(cols[col])
+
+        # Planet radius in log scale
+        if "pl_rade" in cols:
+            df["log_radius_earth"] = safe_log10(cols["pl_rade"])
+
+        # Stellar luminosity from log to linear
+        if "st_lum" in cols:
+            lum = np.power(np.float32(10.0), cols["st_lum"])
+            df["st_lum_linear"] = lum
+
+            # Habitable zone estimate (simple sqrt(luminosity) scaling)
+            sqrt_lum = np.sqrt(lum)
+            hz_inner = np.float32(0.75) * sqrt_lum
+            hz_outer = np.float32(1.77) * sqrt_lum
+            df["hz_inner_au"] = hz_inner
+            df["hz_outer_au"] = hz_outer
+            if "pl_orbsmax" in cols:
+                sma = cols["pl_orbsmax"]
+                df["in_hz"] = ((sma >= hz_inner) &
+                               (sma <= hz_outer)).astype(np.int8)
+
+        if "pl_bmasse" in cols and "pl_rade" in cols:
+            m = cols["pl_bmasse"]
+            r = cols["pl_rade"]
+
+            # Surface gravity estimate: g ~ M/R^2 (in Earth units)
+            surf_grav = ne.evaluate("m / r**2", local_dict={"m": m, "r": r})
+            df["pl_surf_grav_earth"] = surf_grav
+            df["log_surf_grav"] = safe_log10(surf_grav)
+
+            # Escape velocity estimate: v_esc ~ sqrt(M/R) (relative to Earth)
+            df["pl_vesc_earth"] = np.sqrt(m / np.where(r == 0, np.nan, r))
+
+        # TSM-like metric (Transmission Spectroscopy Metric, simplified)
+        # TSM ~ (Rp^3 * Teq) / (Mp * Rs^2 * 10^(mag/5))
+        if all(c in cols for c in
+               ["pl_rade", "pl_eqt", "pl_bmasse", "st_rad", "sy_jmag"]):
+            # Evaluated in a single fused pass, without per-operator temporaries
+            df["tsm_approx"] = ne.evaluate(
+                "(rp**3 * teq) / (mp * rs**2 * 10**(jmag / 5))",
+                local_dict={
+                    "rp": cols["pl_rade"],
+                    "teq": cols["pl_eqt"],
+                    "mp": cols["pl_bmasse"],
+                    "rs": cols["st_rad"],
+                    "jmag": cols["sy_jmag"],
+                })
+
+        # Color indices
+        if "sy_bmag" in cols and "sy_vmag" in cols:
+            df["bv_color"] = cols["sy_bmag"] - cols["sy_vmag"]
+        if "sy_jmag" in cols and "sy_hmag" in cols:
+            df["jh_color"] = cols["sy_jmag"] - cols["sy_hmag"]
+        if "sy_hmag" in cols and "sy_kmag" in cols:
+            df["hk_color"] = cols["sy_hmag"] - cols["sy_kmag"]
+        if "sy_jmag" in cols and "sy_kmag" in cols:
+            df["jk_color"] = cols["sy_jmag"] - cols["sy_kmag"]
 
     return df
 
@@ -180,19 +205,24 @@ def main():
     print("─── Querying NASA Exoplanet Archive ───")
     print(f"Table:   pscomppars (SELECT *)")
 
-    resp = requests.get(TAP_URL, params={
+    # Stream the response straight into the C parser rather than buffering
+    # the whole body (and a decoded copy of it) in memory first
+    with requests.get(TAP_URL, params={
         "query": query,
         "format": "csv",
-    }, timeout=180)
-    resp.raise_for_status()
-
-    print(f"Download: {len(resp.content) / 1048576:.1f} MB")
+    }, stream=True, timeout=180) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        # Keep only the columns we care about; the parser skips the rest
+        # (the archive returns ~300) instead of converting and dropping them
+        keep_set = set(KEEP_COLUMNS)
+        df = pd.read_csv(resp.raw, low_memory=False,
+                         usecols=lambda c: c in keep_set)
+        print(f"Download: {resp.raw.tell() / 1048576:.1f} MB")
 
-    df = pd.read_csv(io.StringIO(resp.text), low_memory=False)
     print(f"Rows:    {len(df):,}")
-    print(f"Columns from archive: {len(df.columns)}")
 
-    # Keep only the columns we care about (skip any that don't exist)
+    # Restore KEEP_COLUMNS order (skip any that don't exist)
     present = [c for c in KEEP_COLUMNS if c in df.columns]
     missing = [c for c in KEEP_COLUMNS if c not in df.columns]
     if missing:
@@ -200,14 +230,6 @@ def main():
     df = df[present]
     print(f"Kept:    {len(df.columns)} columns")
 
-    # ── Encode string columns as categoricals ──────────────────────────
-    string_cols = ["pl_name", "hostname", "pl_letter", "discoverymethod",
-                   "disc_facility", "pl_bmassprov", "st_spectype",
-                   "st_metratio"]
-    for col in string_cols:
-        if col in df.columns:
-            df[col] = df[col].astype("category")
-
     # ── Add derived columns ────────────────────────────────────────────
     print("\n─── Computing derived columns ───")
     n_before = len(df.columns)
@@ -226,7 +248,10 @@ def main():
 
     # ── Write Parquet ──────────────────────────────────────────────────
     print(f"\n─── Writing Parquet ───")
-    df.to_parquet(OUTPUT_FILE, engine="pyarrow", index=False)
+    # String columns stay plain strings; pyarrow dictionary-encodes their
+    # pages on write (use_dictionary defaults to True)
+    df.to_parquet(OUTPUT_FILE, engine="pyarrow", index=False,
+                  compression="zstd", compression_level=3)
 
     mb = os.path.getsize(OUTPUT_FILE) / 1048576
     print(f"File:    {OUTPUT_FILE}")
@@ -13,9 +13,10 @@ API endpoint:
 """
 
 import urllib.request
-import io
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
 import pyarrow.parquet as pq
 import pandas as pd
 import os
@@ -23,93 +24,137 @@ import os
 API_URL = "https://nds.iaea.org/relnsd/v1/data?fields=ground_states&nuclides=all"
 OUTPUT = "nuclides.parquet"
 
+# Numeric IAEA columns and their output names. Optional fields (isospin,
+# qbm_n, decay_i_%) are converted only when the API returns them.
+NUMERIC_COLUMNS = {
+    "z": "Z",
+    "n": "N",
+    "binding": "binding_per_A",
+    "massexcess": "mass_excess",
+    "atomic_mass": "atomic_mass",
+    "half_life_sec": "half_life_sec",
+    "isospin": "isospin",
+    "radius": "radius",
+    "abundance": "abundance",
+    "sn": "Sn",
+    "sp": "Sp",
+    "qa": "Qa",
+    "qbm": "Qbm",
+    "qec": "Qec",
+    "qbm_n": "Qbm_n",
+    "magnetic_dipole": "mag_dipole",
+    "electric_quadrupole": "elec_quadrupole",
+    "decay_1_%": "decay_1_%",
+    "decay_2_%": "decay_2_%",
+    "decay_3_%": "decay_3_%",
+    "discovery": "discovery",
+}
+
 
 def download():
     print("  Downloading ground-state data from IAEA NDS...")
     req = urllib.request.Request(API_URL, headers={"User-Agent": "Mozilla/5.0"})
     with urllib.request.urlopen(req, timeout=60) as resp:
-        text = resp.read().decode("utf-8")
-    df = pd.read_csv(io.StringIO(text))
+        table = pcsv.read_csv(pa.py_buffer(resp.read()))
+    df = table.to_pandas()
     print(f"  Raw: {len(df)} nuclides x {len(df.columns)} columns")
     print(f"  Columns: {list(df.columns)}")
     return df
 
 
+def to_f32(col):
+    """Convert a column straight to float32; unparseable entries become NaN."""
+    if not pd.api.types.is_numeric_dtype(col):
+        # Stray text in a numeric field: coerce to numbers first
+        col = pd.to_numeric(col, errors="coerce")
+    arr = pa.array(col, from_pandas=True)
+    return pc.cast(arr, pa.float32(), safe=False).to_numpy(zero_copy_only=False)
+
+
+def strip_strings(col):
+    """Stripped str of each value ("" if missing), via a plain comprehension.
+
+    Cheaper than chaining .astype(str).str.strip() on short strings.
+    """
+    return [str(s).strip() if pd.notna(s) else "" for s in col.to_numpy()]
+
+
 def clean(df):
     """Select, rename, and transform columns into a clean parquet."""
 
     out = pd.DataFrame()
 
+    # Convert every numeric column once, directly to its final float32 dtype
+    num = {new: to_f32(df[old]) for old, new in NUMERIC_COLUMNS.items()
+           if old in df.columns}
+
     # --- Identity ---
-    out["Z"] = pd.to_numeric(df["z"], errors="coerce")
-    out["N"] = pd.to_numeric(df["n"], errors="coerce")
+    out["Z"] = num["Z"]
+    out["N"] = num["N"]
     out["A"] = out["Z"] + out["N"]
-    out["symbol"] = df["symbol"].astype(str).str.strip()
+    out["symbol"] = strip_strings(df["symbol"])
 
     # --- Masses (keV and micro-u) ---
     # IAEA "binding" field is already binding energy per nucleon (keV)
-    out["binding_per_A"] = pd.to_numeric(df["binding"], errors="coerce")
-    out["mass_excess"] = pd.to_numeric(df["massexcess"], errors="coerce")
-    out["atomic_mass"] = pd.to_numeric(df["atomic_mass"], errors="coerce")
+    out["binding_per_A"] = num["binding_per_A"]
+    out["mass_excess"] = num["mass_excess"]
+    out["atomic_mass"] = num["atomic_mass"]
 
     # --- Half-life ---
-    hl_sec = pd.to_numeric(df["half_life_sec"], errors="coerce")
-    out["half_life_log10"] = np.where(hl_sec > 0, np.log10(hl_sec), np.nan)
+    hl_sec = num["half_life_sec"]
+    hl_log10 = np.full(hl_sec.shape, np.nan, dtype=np.float32)
+    np.log10(hl_sec, where=hl_sec > 0, out=hl_log10)
+    out["half_life_log10"] = hl_log10
     # Stable nuclides have half_life text == "STABLE" in the IAEA data;
     # set to 50 so they're visible on plots (max unstable is ~32 in log10 s)
-    stable_mask = df["half_life"].astype(str).str.strip().str.upper() == "STABLE"
+    stable_mask = np.array(
+        [s.upper() == "STABLE" for s in strip_strings(df["half_life"])])
     out.loc[stable_mask, "half_life_log10"] = 50.0
 
     # --- Spin, parity, isospin ---
-    out["jp"] = df["jp"].astype(str).str.strip() if "jp" in df.columns else np.nan
+    out["jp"] = strip_strings(df["jp"]) if "jp" in df.columns else np.nan
     # Mark truly missing jp as empty string
     out.loc[out["jp"].isin(["nan", ""]), "jp"] = ""
 
-    if "isospin" in df.columns:
-        out["isospin"] = pd.to_numeric(df["isospin"], errors="coerce")
+    if "isospin" in num:
+        out["isospin"] = num["isospin"]
 
     # --- Nuclear radius ---
-    out["radius"] = pd.to_numeric(df["radius"], errors="coerce")
+    out["radius"] = num["radius"]
 
     # --- Natural abundance ---
-    out["abundance"] = pd.to_numeric(df["abundance"], errors="coerce")
+    out["abundance"] = num["abundance"]
 
     # --- Separation energies (keV) ---
-    out["Sn"] = pd.to_numeric(df["sn"], errors="coerce")
-    out["Sp"] = pd.to_numeric(df["sp"], errors="coerce")
+    out["Sn"] = num["Sn"]
+    out["Sp"] = num["Sp"]
 
     # --- Q-values (keV) ---
-    out["Qa"] = pd.to_numeric(df["qa"], errors="coerce")
-    out["Qbm"] = pd.to_numeric(df["qbm"], errors="coerce")
-    out["Qec"] = pd.to_numeric(df["qec"], errors="coerce")
-    if "qbm_n" in df.columns:
-        out["Qbm_n"] = pd.to_numeric(df["qbm_n"], errors="coerce")
+    out["Qa"] = num["Qa"]
+    out["Qbm"] = num["Qbm"]
+    out["Qec"] = num["Qec"]
+    if "Qbm_n" in num:
+        out["Qbm_n"] = num["Qbm_n"]
 
     # --- Electromagnetic moments ---
-    out["mag_dipole"] = pd.to_numeric(df["magnetic_dipole"], errors="coerce")
-    out["elec_quadrupole"] = pd.to_numeric(df["electric_quadrupole"], errors="coerce")
+    out["mag_dipole"] = num["mag_dipole"]
+    out["elec_quadrupole"] = num["elec_quadrupole"]
 
     # --- Decay modes ---
     for i in range(1, 4):
         mode_col = f"decay_{i}"
         pct_col = f"decay_{i}_%"
         if mode_col in df.columns:
-            out[mode_col] = df[mode_col].astype(str).str.strip()
+            out[mode_col] = strip_strings(df[mode_col])
             out.loc[out[mode_col].isin(["nan", ""]), mode_col] = ""
-        if pct_col in df.columns:
-            out[pct_col] = pd.to_numeric(df[pct_col], errors="coerce")
+        if pct_col in num:
+            out[pct_col] = num[pct_col]
 
     # --- Discovery year ---
-    out["discovery"] = pd.to_numeric(df["discovery"], errors="coerce")
-
-    # Cast float columns to float32 for compactness
-    float_cols = out.select_dtypes(include=["float64"]).columns
-    for col in float_cols:
-        out[col] = out[col].astype("float32")
+    out["discovery"] = num["discovery"]
 
-    # Cast Z, N, A to int16
-    for col in ["Z", "N", "A"]:
-        out[col] = out[col].astype("int16")
+    # Cast Z, N, A to int16 (float columns are already float32)
+    out = out.astype({col: "int16" for col in ["Z", "N", "A"]})
 
     return out
 
@@ -122,7 +167,7 @@ def main():
     print(f"  Columns: {list(out.columns)}")
 
     table = pa.Table.from_pandas(out, preserve_index=False)
-    pq.write_table(table, OUTPUT)
+    pq.write_table(table, OUTPUT, compression="zstd", compression_level=3)
     size_kb = os.path.getsize(OUTPUT) / 1024
     print(f"  Wrote {OUTPUT} ({size_kb:.0f} KB)")
 
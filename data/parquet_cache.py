@@ -0,0 +1,47 @@
+"""Shared helpers for the dataset build scripts' Parquet outputs.
+
+Each output records the hash of its inputs and the builder's version in the
+Parquet footer, so a rerun with the same pair can skip the rebuild.
+"""
+
+import contextlib
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def cache_metadata(src_hash, script_version):
+    """Footer key-value metadata recording what an output was built from."""
+    return {
+        b"src_hash": src_hash.encode(),
+        b"script_version": script_version.encode(),
+    }
+
+
+def output_is_current(path, src_hash, script_version):
+    """True if `path` was built by `script_version` from `src_hash`."""
+    if src_hash is None or not os.path.exists(path):
+        return False
+    try:
+        meta = pq.read_metadata(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    expected = cache_metadata(src_hash, script_version)
+    return all(meta.get(k) == v for k, v in expected.items())
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """Yield a temporary path that is renamed to `path` only on success.
+
+    An interrupted build never leaves a partial file that looks up to date,
+    and the temporary file is removed on error.
+    """
+    tmp_path = path + ".part"
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
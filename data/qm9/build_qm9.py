@@ -7,99 +7,128 @@ of 134 kilo molecules", Scientific Data 1, 140022 (2014).
 Uses the preprocessed CSV from DeepChem/MoleculeNet which includes SMILES.
 """
 
+import hashlib
 import os
-import subprocess
+import sys
+import urllib.request
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import pyarrow.csv as pcsv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquet_cache import atomic_output, cache_metadata, output_is_current
+
 CSV_URL = "https://deepchemdata.s3-us-west-1.amazonaws.com/datasets/qm9.csv"
-CSV_FILE = "qm9.csv"
 OUTPUT = "qm9.parquet"
 
-
-def download(url, dest):
-    if os.path.exists(dest) and os.path.getsize(dest) > 0:
-        print(f"  {dest} already exists, skipping download")
-        return
-    print(f"  Downloading {dest}...")
-    subprocess.run(["curl", "-L", "-o", dest, url], check=True)
-    print(f"  Done ({os.path.getsize(dest) / 1e6:.1f} MB)")
+# Bump when the output layout changes, so existing files get rebuilt
+SCRIPT_VERSION = "1.0"
+
+# Select and rename columns for Viewpoints
+# Original: mol_id, smiles, A, B, C, mu, alpha, homo, lumo, gap, r2,
+#           zpve, u0, u298, h298, g298, cv, u0_atom, u298_atom, h298_atom, g298_atom
+RENAME = {
+    "A": "rot_A",
+    "B": "rot_B",
+    "C": "rot_C",
+    "mu": "dipole",
+    "alpha": "polarizability",
+    "homo": "HOMO",
+    "lumo": "LUMO",
+    "gap": "gap",
+    "r2": "R2",
+    "zpve": "ZPVE",
+    "u0": "U0",
+    "u298": "U298",
+    "h298": "H298",
+    "g298": "G298",
+    "cv": "Cv",
+}
+
+
+def source_hash():
+    """Hash the CSV's HTTP validators (ETag, Last-Modified, size).
+
+    Returns None when the server sends neither ETag nor Last-Modified, since
+    the content then cannot be tracked and the output is always rebuilt.
+    """
+    req = urllib.request.Request(CSV_URL, method="HEAD")
+    with urllib.request.urlopen(req) as resp:
+        headers = resp.headers
+    etag, modified = headers.get("ETag"), headers.get("Last-Modified")
+    if etag is None and modified is None:
+        return None
+    ident = f"{CSV_URL}|{etag}|{modified}|{headers.get('Content-Length')}"
+    return hashlib.sha256(ident.encode()).hexdigest()
+
+
+def atom_counts(smiles):
+    """Count heavy atoms from SMILES (simple heuristic: element symbols)."""
+    def count(sub):
+        return pc.cast(pc.count_substring(smiles, sub), pa.int32())
+
+    n_C = pc.subtract(count("C"), count("Cl"))  # C but not Cl
+    n_N = count("N")
+    n_O = count("O")
+    n_F = pc.subtract(count("F"), count("Fe"))  # F but not Fe (unlikely in QM9)
+    n_heavy = pc.add(pc.add(pc.add(n_C, n_N), n_O), n_F)
+    return {"n_C": n_C, "n_N": n_N, "n_O": n_O, "n_F": n_F, "n_heavy": n_heavy}
+
+
+def convert_batch(batch):
+    """Turn one raw CSV record batch into the output column layout."""
+    smiles = batch.column("smiles")
+    arrays = {"smiles": smiles.cast(pa.string())}
+    arrays.update(atom_counts(smiles))
+    for orig, new_name in RENAME.items():
+        arrays[new_name] = batch.column(orig)  # already float32 from the reader
+    return pa.record_batch(list(arrays.values()), names=list(arrays.keys()))
 
 
 def main():
     print("Building QM9 dataset with SMILES column")
-    download(CSV_URL, CSV_FILE)
-
-    # Read CSV
-    print("  Reading CSV...")
-    table = pcsv.read_csv(CSV_FILE)
-    print(f"  Raw: {table.num_rows} rows x {table.num_columns} cols")
-    print(f"  Columns: {table.column_names}")
-
-    # Select and rename columns for Viewpoints
-    # Original: mol_id, smiles, A, B, C, mu, alpha, homo, lumo, gap, r2,
-    #           zpve, u0, u298, h298, g298, cv, u0_atom, u298_atom, h298_atom, g298_atom
-    rename = {
-        "smiles": "smiles",
-        "A": "rot_A",
-        "B": "rot_B",
-        "C": "rot_C",
-        "mu": "dipole",
-        "alpha": "polarizability",
-        "homo": "HOMO",
-        "lumo": "LUMO",
-        "gap": "gap",
-        "r2": "R2",
-        "zpve": "ZPVE",
-        "u0": "U0",
-        "u298": "U298",
-        "h298": "H298",
-        "g298": "G298",
-        "cv": "Cv",
-    }
-
-    # Also compute atom counts from SMILES
-    smiles_col = table.column("smiles").to_pylist()
-
-    # Count heavy atoms from SMILES (simple heuristic: uppercase letters)
-    n_C, n_N, n_O, n_F, n_heavy = [], [], [], [], []
-    for smi in smiles_col:
-        c = smi.count("C") - smi.count("Cl")  # C but not Cl
-        n = smi.count("N")
-        o = smi.count("O")
-        f = smi.count("F") - smi.count("Fe")  # F but not Fe (unlikely in QM9)
-        n_C.append(c)
-        n_N.append(n)
-        n_O.append(o)
-        n_F.append(f)
-        n_heavy.append(c + n + o + f)
-
-    # Build output columns
-    col_order = ["smiles", "n_C", "n_N", "n_O", "n_F", "n_heavy"]
-    arrays = {
-        "smiles": pa.array(smiles_col, type=pa.string()),
-        "n_C": pa.array(n_C, type=pa.int32()),
-        "n_N": pa.array(n_N, type=pa.int32()),
-        "n_O": pa.array(n_O, type=pa.int32()),
-        "n_F": pa.array(n_F, type=pa.int32()),
-        "n_heavy": pa.array(n_heavy, type=pa.int32()),
-    }
-
-    for orig, new_name in rename.items():
-        if orig == "smiles":
-            continue
-        col_order.append(new_name)
-        col = table.column(orig)
-        # Cast to float32
-        arrays[new_name] = col.cast(pa.float32())
-
-    out_table = pa.table({col: arrays[col] for col in col_order})
-
-    pq.write_table(out_table, OUTPUT)
+
+    src_hash = source_hash()
+    if output_is_current(OUTPUT, src_hash, SCRIPT_VERSION):
+        print(f"  {OUTPUT} is up to date, skipping")
+        return
+
+    # Stream the CSV straight from the URL into Parquet row groups: one pass
+    # over the bytes, and no intermediate CSV on disk
+    print(f"  Streaming {CSV_URL}...")
+    read_options = pcsv.ReadOptions(block_size=8 << 20)
+    convert_options = pcsv.ConvertOptions(
+        include_columns=["smiles"] + list(RENAME),
+        column_types={"smiles": pa.string(),
+                      **{orig: pa.float32() for orig in RENAME}},
+    )
+
+    num_rows = 0
+    with urllib.request.urlopen(CSV_URL) as resp, atomic_output(OUTPUT) as tmp_path:
+        reader = pcsv.open_csv(pa.PythonFile(resp, mode="r"),
+                               read_options=read_options,
+                               convert_options=convert_options)
+        # Derive the output schema from an empty batch, so a CSV with no
+        # rows still produces an (empty) table
+        schema = convert_batch(
+            pa.RecordBatch.from_pylist([], schema=reader.schema)).schema
+        if src_hash is not None:
+            schema = schema.with_metadata(cache_metadata(src_hash, SCRIPT_VERSION))
+        writer = pq.ParquetWriter(tmp_path, schema,
+                                  compression="zstd", compression_level=3)
+        try:
+            for batch in reader:
+                out_batch = convert_batch(batch)
+                writer.write_batch(out_batch)
+                num_rows += out_batch.num_rows
+        finally:
+            writer.close()
+
+    schema = pq.read_schema(OUTPUT)
     size_mb = os.path.getsize(OUTPUT) / 1e6
-    print(f"  Wrote {OUTPUT}: {out_table.num_rows} rows x {out_table.num_columns} cols ({size_mb:.1f} MB)")
-    print(f"  Columns: {out_table.column_names}")
+    print(f"  Wrote {OUTPUT}: {num_rows} rows x {len(schema.names)} cols ({size_mb:.1f} MB)")
+    print(f"  Columns: {schema.names}")
 
 
 if __name__ == "__main__":
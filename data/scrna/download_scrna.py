@@ -6,20 +6,38 @@ embeddings, marker genes, and QC metrics to Parquet for Viewpoints.
 Install dependencies:
     pip install scanpy leidenalg pandas pyarrow
 
+Optional (CUDA GPU; PCA, neighbors, UMAP, t-SNE and Leiden run on the GPU):
+    pip install rapids-singlecell
+
 Run:
     python data/scrna/download_scrna.py
 """
 
+import hashlib
 import os
+import sys
 import warnings
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import scanpy as sc
+import scipy.sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquet_cache import atomic_output, cache_metadata, output_is_current
+
+try:
+    import rapids_singlecell as rsc  # optional GPU backend for embeddings
+except ImportError:
+    rsc = None
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 OUTPUT_FILE = "data/scrna/pbmc_scrna.parquet"
 
+# Bump when the processing or output layout changes, so existing files get rebuilt
+SCRIPT_VERSION = "1.1"
+
 # Number of PCA components to export
 N_PCS = 50
 
@@ -103,14 +121,18 @@ def download_pbmc():
             with urllib.request.urlopen(req) as resp, open(h5_path, "wb") as f:
                 total = int(resp.headers.get("Content-Length", 0))
                 downloaded = 0
+                # Large reads, and progress only every 64 MB (or at the end)
+                # rather than one terminal write per chunk
+                next_report = 0
                 while True:
-                    chunk = resp.read(1 << 20)
+                    chunk = resp.read(8 << 20)
                     if not chunk:
                         break
                     f.write(chunk)
                     downloaded += len(chunk)
-                    if total:
+                    if total and (downloaded >= next_report or downloaded >= total):
                         print(f"\r  {downloaded / 1e6:.1f} / {total / 1e6:.1f} MB", end="")
+                        next_report = downloaded + (64 << 20)
                 print(f"\n  Saved to {h5_path}")
         except Exception as e:
             if os.path.exists(h5_path):
@@ -130,8 +152,10 @@ def preprocess(adata):
     """Standard scanpy preprocessing pipeline."""
     print("\n--- QC filtering ---")
     # Compute QC metrics
-    adata.var["mt"] = adata.var_names.str.startswith("MT-")
-    adata.var["ribo"] = adata.var_names.str.startswith(("RPS", "RPL"))
+    names = np.asarray(adata.var_names, dtype=str)
+    adata.var["mt"] = np.char.startswith(names, "MT-")
+    adata.var["ribo"] = (np.char.startswith(names, "RPS") |
+                         np.char.startswith(names, "RPL"))
     sc.pp.calculate_qc_metrics(
         adata, qc_vars=["mt", "ribo"], percent_top=None, log1p=False, inplace=True
     )
@@ -144,15 +168,14 @@ def preprocess(adata):
     print(f"  {n_before:,} -> {adata.n_obs:,} cells after QC")
 
     print("\n--- Normalization ---")
-    # Save raw counts for later
-    adata.layers["raw_counts"] = adata.X.copy()
     sc.pp.normalize_total(adata, target_sum=1e4)
     sc.pp.log1p(adata)
     adata.raw = adata  # freeze log-normalized data
 
     print("\n--- Feature selection ---")
-    sc.pp.highly_variable_genes(adata, n_top_genes=2000, flavor="seurat_v3",
-                                 layer="raw_counts")
+    # cell_ranger works on the log-normalized .X with closed-form binned
+    # dispersions: no loess fit (as in seurat_v3) and no raw-count layer
+    sc.pp.highly_variable_genes(adata, n_top_genes=2000, flavor="cell_ranger")
     n_hvg = adata.var["highly_variable"].sum()
     print(f"  {n_hvg} highly variable genes selected")
 
@@ -160,27 +183,52 @@ def preprocess(adata):
 
 
 def compute_embeddings(adata):
-    """Compute PCA, neighbors, UMAP, t-SNE, and Leiden clustering."""
+    """Compute PCA, neighbors, UMAP, t-SNE, and Leiden clustering.
+
+    Runs on the GPU via rapids_singlecell when it is installed, otherwise
+    on the CPU with scanpy.
+    """
+    if rsc is not None:
+        print("\n(using rapids_singlecell GPU backend)")
+        rsc.get.anndata_to_GPU(adata)
+
     print("\n--- PCA ---")
-    sc.pp.scale(adata, max_value=10)
-    sc.tl.pca(adata, n_comps=N_PCS, svd_solver="arpack")
+    if rsc is not None:
+        rsc.pp.scale(adata, max_value=10)
+        rsc.pp.pca(adata, n_comps=N_PCS)
+    else:
+        sc.pp.scale(adata, max_value=10)
+        sc.tl.pca(adata, n_comps=N_PCS, svd_solver="arpack")
     print(f"  {N_PCS} components, variance explained: "
           f"{adata.uns['pca']['variance_ratio'][:5].sum():.1%} (first 5)")
 
     print("\n--- Neighbors + UMAP ---")
-    sc.pp.neighbors(adata, n_neighbors=15, n_pcs=40)
-    sc.tl.umap(adata)
+    if rsc is not None:
+        rsc.pp.neighbors(adata, n_neighbors=15, n_pcs=40)
+        rsc.tl.umap(adata)
+    else:
+        sc.pp.neighbors(adata, n_neighbors=15, n_pcs=40)
+        sc.tl.umap(adata)
 
     print("\n--- t-SNE ---")
-    sc.tl.tsne(adata, n_pcs=40)
+    if rsc is not None:
+        rsc.tl.tsne(adata, n_pcs=40)
+    else:
+        sc.tl.tsne(adata, n_pcs=40)
 
     print("\n--- Leiden clustering ---")
     for res in [0.3, 0.6, 1.0]:
         key = f"leiden_{str(res).replace('.', '_')}"
-        sc.tl.leiden(adata, resolution=res, key_added=key, flavor="igraph")
+        if rsc is not None:
+            rsc.tl.leiden(adata, resolution=res, key_added=key)
+        else:
+            sc.tl.leiden(adata, resolution=res, key_added=key, flavor="igraph")
         n_clusters = adata.obs[key].nunique()
         print(f"  resolution={res}: {n_clusters} clusters")
 
+    if rsc is not None:
+        rsc.get.anndata_to_CPU(adata)
+
     return adata
 
 
@@ -188,27 +236,36 @@ def annotate_cell_types(adata):
     """Annotate cell types based on marker gene expression scores."""
     print("\n--- Cell type annotation ---")
 
-    # Use the log-normalized data (stored in .raw)
-    raw_df = pd.DataFrame(
-        adata.raw.X.toarray() if hasattr(adata.raw.X, "toarray") else adata.raw.X,
-        index=adata.obs_names,
-        columns=adata.raw.var_names,
-    )
-
-    scores = {}
+    # Score = mean log-normalized expression (from .raw) over each type's
+    # markers, for all types at once as X @ M, where column k of M holds
+    # 1/len(markers) at that type's marker genes. Avoids densifying .raw.X.
+    cell_types = []
+    rows, cols, weights = [], [], []
     for ct, markers in CELL_TYPE_MARKERS.items():
-        present = [g for g in markers if g in raw_df.columns]
+        # Hashed lookup into the gene index; -1 marks genes not present
+        idxs = adata.raw.var_names.get_indexer(markers)
+        present = idxs[idxs >= 0].tolist()
         if present:
-            scores[ct] = raw_df[present].mean(axis=1)
-
-    if scores:
-        score_df = pd.DataFrame(scores, index=adata.obs_names)
-        adata.obs["cell_type"] = score_df.idxmax(axis=1)
-        adata.obs["cell_type_score"] = score_df.max(axis=1)
-
-        # Assign "Unknown" where the best score is too low
-        low_score = adata.obs["cell_type_score"] < 0.5
-        adata.obs.loc[low_score, "cell_type"] = "Unknown"
+            k = len(cell_types)
+            cell_types.append(ct)
+            rows.extend(present)
+            cols.extend([k] * len(present))
+            weights.extend([1.0 / len(present)] * len(present))
+
+    if cell_types:
+        M = scipy.sparse.csr_matrix(
+            (weights, (rows, cols)),
+            shape=(adata.raw.n_vars, len(cell_types)), dtype=np.float32)
+        scores = adata.raw.X @ M
+        scores = scores.toarray() if scipy.sparse.issparse(scores) else np.asarray(scores)
+        best = scores.argmax(axis=1)
+        best_score = scores[np.arange(len(best)), best]
+
+        # Assign "Unknown" (the extra last label) where the best score is too
+        # low, before the labels ever reach .obs
+        best[best_score < 0.5] = len(cell_types)
+        adata.obs["cell_type"] = np.asarray(cell_types + ["Unknown"])[best]
+        adata.obs["cell_type_score"] = best_score
 
         counts = adata.obs["cell_type"].value_counts()
         for ct, n in counts.items():
@@ -237,7 +294,7 @@ def find_top_markers(adata):
 
 
 def build_parquet(adata, extra_markers):
-    """Extract embeddings, markers, and metadata into a flat DataFrame."""
+    """Extract embeddings, markers, and metadata into a flat Arrow table."""
     print("\n--- Building Parquet ---")
     data = {}
 
@@ -258,36 +315,51 @@ def build_parquet(adata, extra_markers):
         if col in adata.obs.columns:
             data[col] = adata.obs[col].values.astype(np.float32)
 
-    # Cluster assignments
+    # Cluster assignments (a few dozen labels at most, so int16 suffices)
     for col in adata.obs.columns:
         if col.startswith("leiden_"):
-            data[col] = adata.obs[col].astype(int).values
+            data[col] = adata.obs[col].astype(np.int16).values
 
-    # Cell type
-    data["cell_type"] = adata.obs["cell_type"].values
+    # Cell type. Kept as plain strings rather than a categorical: Parquet
+    # dictionary-encodes the repeated labels on write anyway, and an Arrow
+    # dictionary column would be skipped by the Viewpoints Parquet loader.
+    data["cell_type"] = pa.array(adata.obs["cell_type"].astype(str).to_numpy(),
+                                 type=pa.string())
     if "cell_type_score" in adata.obs.columns:
         data["cell_type_score"] = adata.obs["cell_type_score"].values.astype(np.float32)
 
     # Marker gene expression (log-normalized from .raw)
-    raw_var_names = list(adata.raw.var_names)
-    all_markers = set(MARKER_GENES) | extra_markers
-    present_markers = sorted([g for g in all_markers if g in raw_var_names])
-
-    raw_X = adata.raw.X
-    if hasattr(raw_X, "toarray"):
-        # Sparse matrix - extract columns by index for efficiency
-        for gene in present_markers:
-            idx = raw_var_names.index(gene)
-            data[gene] = np.asarray(raw_X[:, idx].todense()).ravel().astype(np.float32)
-    else:
-        for gene in present_markers:
-            idx = raw_var_names.index(gene)
-            data[gene] = raw_X[:, idx].astype(np.float32)
+    # Resolve all markers in one hashed lookup; -1 marks genes not present
+    all_markers = sorted(set(MARKER_GENES) | extra_markers)
+    idxs = adata.raw.var_names.get_indexer(all_markers)
+    found = idxs >= 0
+    present_markers = [g for g, ok in zip(all_markers, found) if ok]
+    idxs = idxs[found]
+
+    # Slice every marker column in one go from a CSC copy, densifying only
+    # the (n_cells, n_markers) block; column-major so each gene is contiguous
+    raw_csc = scipy.sparse.csc_matrix(adata.raw.X)
+    block = raw_csc[:, idxs].toarray(order="F").astype(np.float32, copy=False)
+    for j, gene in enumerate(present_markers):
+        data[gene] = block[:, j]
 
     print(f"  Marker genes included: {len(present_markers)}")
 
-    df = pd.DataFrame(data)
-    return df
+    # Every column is a contiguous 1-D array, so Arrow wraps it without the
+    # block-consolidation copy a DataFrame would make
+    return pa.table(data)
+
+
+def source_hash(adata):
+    """Hash the raw counts and the export settings that determine the output."""
+    h = hashlib.sha256()
+    X = scipy.sparse.csr_matrix(adata.X)
+    for arr in (X.data, X.indices, X.indptr):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update("\n".join(adata.obs_names).encode())
+    h.update("\n".join(adata.var_names).encode())
+    h.update(f"{N_PCS}|{MARKER_GENES}|{CELL_TYPE_MARKERS}".encode())
+    return h.hexdigest()
 
 
 def main():
@@ -298,6 +370,13 @@ def main():
     print("=== Download ===")
     adata = download_pbmc()
 
+    # Preprocessing and embeddings dominate the runtime; skip them entirely
+    # when the existing output was built from the same counts and settings
+    src_hash = source_hash(adata)
+    if output_is_current(OUTPUT_FILE, src_hash, SCRIPT_VERSION):
+        print(f"\n{OUTPUT_FILE} is up to date, skipping")
+        return
+
     # 2) Preprocess
     print("\n=== Preprocess ===")
     adata = preprocess(adata)
@@ -315,19 +394,22 @@ def main():
 
     # 6) Export
     print("\n=== Export ===")
-    df = build_parquet(adata, extra_markers)
+    table = build_parquet(adata, extra_markers)
 
-    df.to_parquet(OUTPUT_FILE, engine="pyarrow", index=False)
+    table = table.replace_schema_metadata(cache_metadata(src_hash, SCRIPT_VERSION))
+    with atomic_output(OUTPUT_FILE) as tmp_path:
+        pq.write_table(table, tmp_path, compression="zstd", compression_level=3)
     mb = os.path.getsize(OUTPUT_FILE) / 1048576
 
     print(f"\nFile:    {OUTPUT_FILE}")
-    print(f"Shape:   {df.shape[0]:,} rows x {df.shape[1]} columns")
+    print(f"Shape:   {table.num_rows:,} rows x {table.num_columns} columns")
     print(f"Size:    {mb:.1f} MB")
 
     # Column summary
-    embed_cols = [c for c in df.columns if c.startswith(("UMAP", "tSNE", "PC_"))]
-    meta_cols = [c for c in df.columns if c.startswith(("n_genes", "total_", "pct_", "leiden_", "cell_type"))]
-    gene_cols = [c for c in df.columns if c not in embed_cols and c not in meta_cols]
+    columns = table.column_names
+    embed_cols = [c for c in columns if c.startswith(("UMAP", "tSNE", "PC_"))]
+    meta_cols = [c for c in columns if c.startswith(("n_genes", "total_", "pct_", "leiden_", "cell_type"))]
+    gene_cols = [c for c in columns if c not in embed_cols and c not in meta_cols]
     print(f"\nEmbeddings:  {len(embed_cols)} ({len([c for c in embed_cols if c.startswith('PC_')])} PCs + UMAP + t-SNE)")
     print(f"Metadata:    {len(meta_cols)} (QC + clusters + cell type)")
     print(f"Genes:       {len(gene_cols)} marker genes")
@@ -5,22 +5,30 @@ extract all spectral bands + ancillary layers + spectral indices,
 and save as a Parquet file with per-pixel XY coordinates.
 
 Install dependencies:
-    pip install pystac-client planetary-computer rasterio rioxarray pandas pyarrow
+    pip install pystac-client planetary-computer rasterio rioxarray pyarrow numba
 
 Run:
     python data/sentinel2/download_sentinel2.py
 """
 
+import hashlib
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import pandas as pd
 import planetary_computer
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pystac_client
 import rasterio
+from numba import njit, prange
 from pyproj import Transformer
 from rasterio.enums import Resampling
 from rasterio.windows import Window
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquet_cache import atomic_output, cache_metadata, output_is_current
+
 # ── Configuration ──────────────────────────────────────────────────────────
 
 BBOX = [-122.65, 37.60, -122.25, 37.90]   # SF Bay Area (search region)
@@ -29,6 +37,17 @@ MAX_CLOUD_COVER = 5                         # percent
 
 CROP_SIZE = 3156         # pixels per side (~9.96 Mpx), divisible by 6
 OUTPUT_FILE = "data/sentinel2/sentinel2_sf_bay.parquet"
+ROW_GROUP_SIZE = 500_000  # rows per Parquet row group (~20 per scene)
+SCRIPT_VERSION = "1.0"    # bump when the output layout changes
+
+READ_WORKERS = 12        # concurrent band reads from the remote COGs
+GDAL_ENV = {
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",  # no sidecar-file probing
+    "VSI_CACHE": "TRUE",                          # per-open block cache
+    "VSI_CACHE_SIZE": str(256 << 20),
+}
 
 # Band definitions by native resolution
 BANDS_10M = ["B02", "B03", "B04", "B08"]
@@ -149,26 +168,27 @@ def read_band(item, key, window_10m, crop_size, ref_shape):
     href = item.assets[key].href
     is_categorical = key == "SCL"
 
-    with rasterio.open(href) as src:
+    # One open per COG: the header/IFD fetch is a remote round-trip.
+    # rasterio keeps its Env per thread, so enter it here on the worker.
+    with rasterio.Env(**GDAL_ENV), rasterio.open(href) as src:
         native_h, native_w = src.height, src.width
 
-    # Determine resolution ratio relative to 10m reference
-    ref_h, ref_w = ref_shape
-    ratio_w = ref_w // native_w if native_w > 0 else 1
-    ratio_h = ref_h // native_h if native_h > 0 else 1
-    ratio = ratio_w if ratio_w == ratio_h and ratio_w in (1, 2, 6) else 1
-
-    if ratio == 1:
-        window = window_10m
-    else:
-        window = Window(
-            window_10m.col_off // ratio,
-            window_10m.row_off // ratio,
-            window_10m.width // ratio,
-            window_10m.height // ratio,
-        )
+        # Determine resolution ratio relative to 10m reference
+        ref_h, ref_w = ref_shape
+        ratio_w = ref_w // native_w if native_w > 0 else 1
+        ratio_h = ref_h // native_h if native_h > 0 else 1
+        ratio = ratio_w if ratio_w == ratio_h and ratio_w in (1, 2, 6) else 1
+
+        if ratio == 1:
+            window = window_10m
+        else:
+            window = Window(
+                window_10m.col_off // ratio,
+                window_10m.row_off // ratio,
+                window_10m.width // ratio,
+                window_10m.height // ratio,
+            )
 
-    with rasterio.open(href) as src:
         data = src.read(
             1,
             window=window,
@@ -181,59 +201,103 @@ def read_band(item, key, window_10m, crop_size, ref_shape):
     return data
 
 
+# Spectral indices, in output order (leading axis of _compute_all's `out`)
+INDEX_NAMES = [
+    "ndvi", "re_ndvi", "evi", "savi",       # vegetation
+    "ndwi", "mndwi",                        # water
+    "ndmi", "nbr",                          # moisture & burn
+    "ndbi", "bsi",                          # built-up & soil
+    "mcari", "cri",                         # chlorophyll / red-edge
+    "nir_red_ratio", "swir_nir_ratio", "red_edge_slope",  # band ratios
+]
+
+_EPS = np.float32(1e-10)
+_ONE = np.float32(1.0)
+
+
+@njit(inline="always")
+def _ndi(a, b):
+    """Normalized difference: (a - b) / (a + b)."""
+    return (a - b) / (a + b + _EPS)
+
+
+@njit(inline="always")
+def _clip1(x):
+    """Clip to [-1, 1]; NaN passes through, as with np.clip."""
+    if x > _ONE:
+        return _ONE
+    if x < -_ONE:
+        return -_ONE
+    return x
+
+
+# fastmath without the no-NaN/no-inf flags: a zero EVI denominator must
+# still give inf (clipped) or NaN exactly like the numpy formulas did
+@njit(parallel=True, cache=True,
+      fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _compute_all(B02, B03, B04, B05, B07, B08, B11, B12, out):
+    """Write every index in INDEX_NAMES for each pixel in a single pass.
+
+    Bands are the raw uint16 reflectance arrays; each value is converted to
+    float32 as it is read.
+    """
+    H, W = B08.shape
+    for i in prange(H):
+        for j in range(W):
+            blu = np.float32(B02[i, j])
+            grn = np.float32(B03[i, j])
+            red = np.float32(B04[i, j])
+            re1 = np.float32(B05[i, j])
+            re3 = np.float32(B07[i, j])
+            nir = np.float32(B08[i, j])
+            sw1 = np.float32(B11[i, j])
+            sw2 = np.float32(B12[i, j])
+
+            # ── Vegetation ─────────────────────────────────────────────
+            out[0, i, j] = _ndi(nir, red)
+            out[1, i, j] = _ndi(re3, re1)                   # red-edge NDVI
+            out[2, i, j] = _clip1(                          # enhanced veg index
+                np.float32(2.5) * (nir - red) /
+                (nir + np.float32(6.0) * red - np.float32(7.5) * blu
+                 + np.float32(10000.0)))
+            out[3, i, j] = _clip1(                          # soil-adjusted veg
+                np.float32(1.5) * (nir - red) / (nir + red + np.float32(5000.0)))
+
+            # ── Water ──────────────────────────────────────────────────
+            out[4, i, j] = _ndi(grn, nir)                   # McFeeters
+            out[5, i, j] = _ndi(grn, sw1)                   # modified NDWI
+
+            # ── Moisture & burn ────────────────────────────────────────
+            out[6, i, j] = _ndi(nir, sw1)                   # moisture
+            out[7, i, j] = _ndi(nir, sw2)                   # burn ratio
+
+            # ── Built-up & soil ────────────────────────────────────────
+            out[8, i, j] = _ndi(sw1, nir)                   # built-up
+            out[9, i, j] = _ndi(sw1 + red, nir + blu)       # bare soil
+
+            # ── Chlorophyll / red-edge ─────────────────────────────────
+            out[10, i, j] = (                               # chlorophyll absorption
+                ((re1 - red) - np.float32(0.2) * (re1 - grn)) *
+                (re1 / (red + _EPS)) / np.float32(1e8))
+            if blu > 0 and re1 > 0:                         # carotenoid reflectance
+                out[11, i, j] = _ONE / blu - _ONE / re1
+            else:
+                out[11, i, j] = 0.0
+
+            # ── Band ratios (simple, sometimes useful) ─────────────────
+            out[12, i, j] = nir / (red + _EPS)
+            out[13, i, j] = sw1 / (nir + _EPS)
+            out[14, i, j] = (re3 - re1) / (np.float32(20.0) + _EPS)  # Δrefl over ~40nm
+
+
 def compute_indices(b):
     """Compute spectral indices from uint16 surface-reflectance bands (scale=10000)."""
-    nir = b["B08"].astype(np.float32)
-    red = b["B04"].astype(np.float32)
-    grn = b["B03"].astype(np.float32)
-    blu = b["B02"].astype(np.float32)
-    sw1 = b["B11"].astype(np.float32)
-    sw2 = b["B12"].astype(np.float32)
-    re1 = b["B05"].astype(np.float32)
-    re2 = b["B06"].astype(np.float32)
-    re3 = b["B07"].astype(np.float32)
-    nna = b["B8A"].astype(np.float32)
-    eps = 1e-10
-
-    def ndi(a, b):
-        """Normalized difference: (a - b) / (a + b)."""
-        return (a - b) / (a + b + eps)
-
-    idx = {}
-
-    # ── Vegetation ─────────────────────────────────────────────────────
-    idx["ndvi"]    = ndi(nir, red)
-    idx["re_ndvi"] = ndi(re3, re1)                         # red-edge NDVI
-    idx["evi"]     = np.clip(                               # enhanced veg index
-        2.5 * (nir - red) / (nir + 6.0 * red - 7.5 * blu + 10000.0), -1, 1)
-    idx["savi"]    = np.clip(                               # soil-adjusted veg
-        1.5 * (nir - red) / (nir + red + 5000.0), -1, 1)
-
-    # ── Water ──────────────────────────────────────────────────────────
-    idx["ndwi"]    = ndi(grn, nir)                          # McFeeters
-    idx["mndwi"]   = ndi(grn, sw1)                          # modified NDWI
-
-    # ── Moisture & burn ────────────────────────────────────────────────
-    idx["ndmi"]    = ndi(nir, sw1)                          # moisture
-    idx["nbr"]     = ndi(nir, sw2)                          # burn ratio
-
-    # ── Built-up & soil ────────────────────────────────────────────────
-    idx["ndbi"]    = ndi(sw1, nir)                          # built-up
-    idx["bsi"]     = (                                      # bare soil
-        ((sw1 + red) - (nir + blu)) / ((sw1 + red) + (nir + blu) + eps))
-
-    # ── Chlorophyll / red-edge ─────────────────────────────────────────
-    idx["mcari"]   = (                                      # chlorophyll absorption
-        ((re1 - red) - 0.2 * (re1 - grn)) * (re1 / (red + eps)) / 1e8)
-    idx["cri"]     = np.where(                              # carotenoid reflectance
-        (blu > 0) & (re1 > 0), 1.0 / blu - 1.0 / re1, 0.0).astype(np.float32)
-
-    # ── Band ratios (simple, sometimes useful) ─────────────────────────
-    idx["nir_red_ratio"]   = nir / (red + eps)
-    idx["swir_nir_ratio"]  = sw1 / (nir + eps)
-    idx["red_edge_slope"]  = (re3 - re1) / (20.0 + eps)    # Δrefl over ~40nm
-
-    return idx
+    # Bands go in as native uint16; the kernel widens each pixel to float32
+    H, W = b["B08"].shape
+    out = np.empty((len(INDEX_NAMES), H, W), dtype=np.float32)
+    _compute_all(b["B02"], b["B03"], b["B04"], b["B05"],
+                 b["B07"], b["B08"], b["B11"], b["B12"], out)
+    return {name: out[k] for k, name in enumerate(INDEX_NAMES)}
 
 
 # ── Main ───────────────────────────────────────────────────────────────────
@@ -245,6 +309,13 @@ def main():
     print("─── Searching ───")
     item = find_scene()
 
+    # The output is fully determined by the scene and the crop settings
+    src_hash = hashlib.sha256(
+        f"{item.id}|{BBOX}|{CROP_SIZE}".encode()).hexdigest()
+    if output_is_current(OUTPUT_FILE, src_hash, SCRIPT_VERSION):
+        print(f"\n{OUTPUT_FILE} is up to date, skipping")
+        return
+
     # 2) Compute crop window
     print("\n─── Crop window ───")
     window, size, crop_transform, crs, ref_shape = compute_crop_window(item)
@@ -253,17 +324,27 @@ def main():
     print("\n─── Reading bands ───")
     all_keys = BANDS_10M + BANDS_20M + BANDS_60M + ANCILLARY_20M + ANCILLARY_10M
     bands = {}
-    for key in all_keys:
-        data = read_band(item, key, window, size, ref_shape)
-        if data is not None:
-            bands[key] = data
+    # Each read is a latency-bound HTTP range request, so issue them
+    # concurrently (GDAL releases the GIL during I/O)
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        futures = {
+            pool.submit(read_band, item, key, window, size, ref_shape): key
+            for key in all_keys
+        }
+        for fut in as_completed(futures):
+            data = fut.result()
+            if data is not None:
+                bands[futures[fut]] = data
 
     # 4) Pixel coordinates (UTM, at pixel centers)
     print("\n─── Coordinates ───")
-    rows_ix, cols_ix = np.mgrid[0:size, 0:size]
+    # The grid is separable: easting depends only on the column and
+    # northing only on the row, so keep 1-D vectors and expand at assembly
+    ix = np.arange(size, dtype=np.int16)               # row/col columns
+    centers = np.arange(size, dtype=np.float64) + 0.5  # float64 for UTM
     t = crop_transform
-    xs = t.c + (cols_ix + 0.5) * t.a    # easting
-    ys = t.f + (rows_ix + 0.5) * t.e    # northing
+    xs = t.c + centers * t.a            # easting, per column
+    ys = t.f + centers * t.e            # northing, per row
     print(f"X (easting):  {xs.min():.1f} .. {xs.max():.1f}")
     print(f"Y (northing): {ys.min():.1f} .. {ys.max():.1f}")
 
@@ -272,39 +353,67 @@ def main():
     indices = compute_indices(bands)
     print(f"Computed {len(indices)} indices")
 
-    # 6) Assemble dataframe
+    # 6) Assemble and write Parquet
     print("\n─── Assembling Parquet ───")
-    data = {
-        "x_utm": xs.ravel().astype(np.float64),
-        "y_utm": ys.ravel().astype(np.float64),
-        "row":   rows_ix.ravel().astype(np.int16),
-        "col":   cols_ix.ravel().astype(np.int16),
-    }
+    # Per-pixel layers as 2-D (size, size) grids, in output column order
+    grids = {}
 
     # Spectral bands (uint16 surface reflectance, scale factor 10000)
     for key in BANDS_10M + BANDS_20M + BANDS_60M:
         if key in bands:
-            data[BAND_LABELS[key]] = bands[key].ravel()
+            grids[BAND_LABELS[key]] = bands[key]
 
     # Ancillary layers
     for key in ANCILLARY_20M + ANCILLARY_10M:
         if key in bands:
-            arr = bands[key].ravel()
-            data[BAND_LABELS[key]] = arr.astype(np.uint8) if key == "SCL" else arr
+            arr = bands[key]
+            grids[BAND_LABELS[key]] = arr.astype(np.uint8) if key == "SCL" else arr
 
     # Spectral indices (float32)
-    for name, arr in indices.items():
-        data[name] = arr.ravel().astype(np.float32)
-
-    df = pd.DataFrame(data)
-    df.to_parquet(OUTPUT_FILE, engine="pyarrow", index=False)
+    grids.update(indices)
+
+    # Stream slabs of whole image rows (one Parquet row group each) instead
+    # of materializing the full raveled table. Row slices of the grids are
+    # contiguous, so each batch wraps existing memory; only the coordinate
+    # columns are expanded, one slab at a time.
+    # Dictionary encoding only pays off for the class map; reflectances and
+    # indices are near-unique per pixel.
+    rows_per_slab = max(1, ROW_GROUP_SIZE // size)
+    writer = None
+    with atomic_output(OUTPUT_FILE) as tmp_path:
+        try:
+            for r0 in range(0, size, rows_per_slab):
+                r1 = min(r0 + rows_per_slab, size)
+                slab = (r1 - r0, size)
+                columns = {
+                    "x_utm": np.broadcast_to(xs, slab).ravel(),
+                    "y_utm": np.broadcast_to(ys[r0:r1, None], slab).ravel(),
+                    "row":   np.broadcast_to(ix[r0:r1, None], slab).ravel(),
+                    "col":   np.broadcast_to(ix, slab).ravel(),
+                }
+                for name, grid in grids.items():
+                    columns[name] = grid[r0:r1].ravel()
+                batch = pa.record_batch(list(columns.values()),
+                                        names=list(columns.keys()))
+                if writer is None:
+                    schema = batch.schema.with_metadata(
+                        cache_metadata(src_hash, SCRIPT_VERSION))
+                    writer = pq.ParquetWriter(tmp_path, schema,
+                                              compression="zstd",
+                                              compression_level=3,
+                                              use_dictionary=[BAND_LABELS["SCL"]],
+                                              data_page_size=1 << 20)
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
 
     mb = os.path.getsize(OUTPUT_FILE) / 1048576
     print(f"\n─── Done ───")
     print(f"File:    {OUTPUT_FILE}")
-    print(f"Shape:   {df.shape[0]:,} rows x {df.shape[1]} columns")
+    print(f"Shape:   {size * size:,} rows x {len(schema.names)} columns")
     print(f"Size:    {mb:.1f} MB")
-    print(f"Columns: {', '.join(df.columns)}")
+    print(f"Columns: {', '.join(schema.names)}")
 
 
 if __name__ == "__main__":